@@ -6,107 +6,307 @@ Upload CSV file, process in memory, and download results.
 import streamlit as st
 import csv
 import io
-from collections import defaultdict
+import re
+from operator import itemgetter
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 
-def parse_quantity(quantity_str):
-    """Parse quantity string, handling whitespace and commas."""
-    if not quantity_str or quantity_str.strip() == '':
-        return 0
-    cleaned = quantity_str.strip().replace(',', '')
-    try:
-        return int(cleaned)
-    except ValueError:
-        return 0
-
-
-def is_summary_row(row):
-    """Check if a row is a summary/total row that should be skipped."""
-    if not row or len(row) < 1:
-        return True
-    shop = row[0].strip().lower() if row[0] else ''
-    return (shop == '' or 
-            'total' in shop or 
-            'branch total' in shop or 
-            'grand total' in shop or
-            shop.endswith('branch total sale value') or
-            shop.endswith('total branch sale'))
-
-
-def is_allowed_branch(shop_name, allowed_branches):
-    """Check if shop name matches any allowed branch (case-insensitive)."""
-    if not shop_name:
-        return False
-    shop_lower = shop_name.strip().lower()
-    allowed_lower = [branch.lower() for branch in allowed_branches]
-    return shop_lower in allowed_lower
+# Branches pre-filled in the "Branches to Process" field
+ALLOWED_BRANCHES = [
+    'AWAISIA',
+    'BAHRIA TOWN',
+    'IQBAL TOWN',
+    'JOHAR TOWN PHARMACY'
+]
 
+# Positions of the columns we use in the sales report
+SHOP_COL, CODE_COL, NAME_COL, QTY_COL = 0, 3, 4, 6
 
-def analyze_sales_from_string(csv_content, allowed_branches):
-    """
-    Analyze sales data from CSV string content.
-    Groups by shop and product code, then sums quantities.
-    Only processes shops in the allowed_branches list.
-    Uses case-insensitive matching but preserves original case.
-    """
-    sales_data = defaultdict(lambda: defaultdict(lambda: {'name': '', 'quantity': 0}))
-    product_totals = defaultdict(lambda: {'name': '', 'quantity': 0})
-    # Map lowercase shop names to their canonical (first-seen) case
-    shop_case_map = {}
+# Summary rows ("Branch Total", "Grand Total", "... Total Branch Sale", ...)
+# all contain "total", so a single pattern covers them
+SUMMARY_ROW_RE = re.compile(r'total')
 
-    # Decode bytes if needed
-    if isinstance(csv_content, bytes):
-        csv_content = csv_content.decode('utf-8')
+# Content with nothing after the header row (or nothing at all)
+NO_DATA_RE = re.compile(rb'[^\n]*(\n\s*)?\Z')
 
-    # Use StringIO to read from string
-    csv_file = io.StringIO(csv_content)
-    reader = csv.reader(csv_file)
+# Largest int64 magnitudes, for range checking quantity strings
+INT64_MAX_DIGITS = str(2 ** 63 - 1)
+INT64_MIN_DIGITS = str(2 ** 63)
 
-    try:
-        _ = next(reader)  # Skip header row
-    except StopIteration:
-        return sales_data, product_totals
+# Bound on the sum of absolute quantities that keeps every int64 total exact
+QTY_MAGNITUDE_LIMIT = float(2 ** 62)
 
-    for row in reader:
-        if not row or is_summary_row(row):
-            continue
+# Per (shop, code) aggregations; they also merge partial results of the same shape
+SHOP_PRODUCT_AGGREGATIONS = [
+    ('qty', 'sum'),
+    ('name', 'first'),
+    ('name_row', 'min'),
+]
 
-        if len(row) < 7:
-            continue
 
-        shop_original = row[0].strip()
-        shop_lower = shop_original.lower()
-        product_code = row[3].strip() if len(row) > 3 else ''
-        product_name = row[4].strip() if len(row) > 4 else ''
-        quantity_str = row[6].strip() if len(row) > 6 else '0'
+def parse_quantities(qty):
+    """
+    Parse quantity strings, handling whitespace and commas. Invalid values become 0.
+    Unlike int(), values need ASCII digits and must fit in int64; their totals
+    must too, which aggregate_batches checks.
+    """
+    cleaned = pc.replace_substring(pc.utf8_trim_whitespace(qty), ',', '')
+    # Same forms int() accepted, including '_' between digits (ASCII digits only)
+    valid = pc.match_substring_regex(cleaned, r'^[+-]?\d+(_\d+)*$')
+    # Arrow's integer cast rejects a leading '+' and '_' separators
+    digits = pc.replace_substring(
+        pc.utf8_ltrim(pc.if_else(valid, cleaned, '0'), characters='+'), '_', ''
+    )
 
-        if not shop_original or not product_code:
-            continue
+    # Arrow cannot parse values outside int64 even with safe=False, so range
+    # check them up front; equal-length digit strings compare numerically
+    magnitude = pc.utf8_ltrim(digits, characters='-0')
+    length = pc.utf8_length(magnitude)
+    limit = pc.if_else(pc.starts_with(digits, '-'), INT64_MIN_DIGITS, INT64_MAX_DIGITS)
+    fits = pc.or_(
+        pc.less(length, len(INT64_MAX_DIGITS)),
+        pc.and_(pc.equal(length, len(INT64_MAX_DIGITS)), pc.less_equal(magnitude, limit)),
+    )
+    return pc.cast(pc.if_else(fits, digits, '0'), pa.int64())
 
-        # Case-insensitive branch check
-        if not is_allowed_branch(shop_original, allowed_branches):
-            continue
 
-        # Normalize shop name: use first-seen case as canonical
-        if shop_lower not in shop_case_map:
-            shop_case_map[shop_lower] = shop_original
-        shop_canonical = shop_case_map[shop_lower]
+def is_summary_shop(shop_lower):
+    """Check if a normalized shop value marks a summary/total row that should be skipped."""
+    return not shop_lower or SUMMARY_ROW_RE.search(shop_lower) is not None
 
-        quantity = parse_quantity(quantity_str)
 
-        if not sales_data[shop_canonical][product_code]['name']:
-            sales_data[shop_canonical][product_code]['name'] = product_name
+def allowed_branch_mask(shop_lower, allowed_lower):
+    """Mark rows whose shop is in the set of lowercased allowed branches."""
+    return pc.is_in(shop_lower, value_set=pa.array(list(allowed_lower), pa.string()))
 
-        sales_data[shop_canonical][product_code]['quantity'] += quantity
 
-        if not product_totals[product_code]['name']:
-            product_totals[product_code]['name'] = product_name
-        product_totals[product_code]['quantity'] += quantity
+def group_by_shop_and_code(rows):
+    """
+    Group rows by (shop, code), keeping the input column names.
+    Runs single-threaded so 'first' keeps input order and groups are
+    emitted in order of first appearance.
+    """
+    grouped = rows.group_by(['shop_lower', 'code'], use_threads=False).aggregate(
+        SHOP_PRODUCT_AGGREGATIONS
+    )
+    renamed = {f'{column}_{function}': column for column, function in SHOP_PRODUCT_AGGREGATIONS}
+    return grouped.rename_columns([renamed.get(column, column) for column in grouped.column_names])
 
-    return sales_data, product_totals
 
+def open_sales_reader(csv_content, allowed_lower, ragged_rows):
+    """
+    Open a streaming CSV reader yielding batches of shop, code, name and qty columns.
+    Only the four columns we need are materialized, all as strings.
+    Arrow cannot read rows whose width differs from the header's. Those that
+    would be filtered out anyway (too short, or not an allowed branch) are
+    skipped; any other is appended to ragged_rows and reading stops with
+    ArrowInvalid, possibly already when opening.
+    Raises ArrowKeyError if the header is narrower than the report format.
+    Returns None if there is nothing after the header row.
+    """
+    # Arrow cannot infer the columns of a lone header without a trailing newline
+    if NO_DATA_RE.match(csv_content):
+        return None
+
+    # Columns are named f0, f1, ... from the header row, which is then skipped
+    selected = [f'f{i}' for i in (SHOP_COL, CODE_COL, NAME_COL, QTY_COL)]
+
+    def handle_invalid_row(row):
+        if row.actual_columns <= QTY_COL:
+            return 'skip'
+        fields = next(csv.reader([row.text]))
+        if fields[SHOP_COL].strip().lower() not in allowed_lower or not fields[CODE_COL].strip():
+            return 'skip'
+        ragged_rows.append(row.number)
+        return 'error'
+
+    return pacsv.open_csv(
+        pa.BufferReader(csv_content),
+        read_options=pacsv.ReadOptions(
+            autogenerate_column_names=True,
+            skip_rows_after_names=1,
+            block_size=8 << 20,
+        ),
+        parse_options=pacsv.ParseOptions(
+            delimiter=',',
+            invalid_row_handler=handle_invalid_row,
+        ),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=selected,
+            column_types={name: pa.string() for name in selected},
+        ),
+    )
+
+
+def parse_sales_batches(csv_content, batch_rows=1 << 16):
+    """
+    Yield the same batches as open_sales_reader, parsed row by row with csv.reader.
+    Used for reports whose rows differ in width, or whose header is narrower
+    than the data rows, which Arrow cannot read.
+    Any row with at least QTY_COL + 1 fields is kept; extra fields are ignored.
+    """
+    reader = csv.reader(io.StringIO(csv_content.decode('utf-8')))
+    next(reader, None)  # Skip header row
 
-def generate_csv_string(sales_data, product_totals):
+    columns = ([], [], [], [])
+    for row in reader:
+        if len(row) <= QTY_COL:
+            continue
+        for column, index in zip(columns, (SHOP_COL, CODE_COL, NAME_COL, QTY_COL)):
+            column.append(row[index])
+        if len(columns[0]) == batch_rows:
+            yield pa.record_batch([pa.array(column, pa.string()) for column in columns],
+                                  names=['shop', 'code', 'name', 'qty'])
+            columns = ([], [], [], [])
+    if columns[0]:
+        yield pa.record_batch([pa.array(column, pa.string()) for column in columns],
+                              names=['shop', 'code', 'name', 'qty'])
+
+
+def aggregate_batches(batches, allowed_lower):
+    """
+    Aggregate each batch per (shop, code), numbering rows across batches.
+    Raises ValueError if the quantities are too large to total exactly.
+    """
+    partials = []
+    first_row = 0
+    magnitude = 0.0
+    for batch in batches:
+        grouped, batch_magnitude = aggregate_batch(batch, allowed_lower, first_row)
+        partials.append(grouped)
+        first_row += batch.num_rows
+        magnitude += batch_magnitude
+
+    # Arrow's int64 sums wrap around silently. No total can overflow while the
+    # sum of absolute quantities stays below the limit, which keeps headroom
+    # for float rounding
+    if magnitude >= QTY_MAGNITUDE_LIMIT:
+        raise ValueError('Quantities are too large to total exactly (int64 overflow)')
+    return partials
+
+
+def aggregate_batch(batch, allowed_lower, first_row):
+    """
+    Filter one batch of report rows and sum its quantities per (shop, code).
+    first_row is the file position of the batch's first row.
+    Returns the grouped table and the sum of absolute quantities (a float).
+    """
+    row_numbers = pa.array(np.arange(first_row, first_row + batch.num_rows, dtype=np.int64))
+
+    # Filter on the shop first so the other fields are only cleaned for kept rows
+    shop_lower = pc.utf8_lower(pc.utf8_trim_whitespace(batch.column(0)))
+    keep = allowed_branch_mask(shop_lower, allowed_lower)
+    batch = batch.filter(keep)
+    shop_lower = pc.filter(shop_lower, keep)
+    row_numbers = pc.filter(row_numbers, keep)
+
+    code = pc.utf8_trim_whitespace(batch.column(1))
+    name = pc.utf8_trim_whitespace(batch.column(2))
+    # Empty names become null so 'first' picks the first non-empty one
+    missing_name = pc.equal(name, '')
+    rows = pa.table({
+        'shop_lower': shop_lower,
+        'code': code,
+        'name': pc.if_else(missing_name, pa.scalar(None, pa.string()), name),
+        # Row number of each non-empty name, to pick the first name per product
+        'name_row': pc.if_else(missing_name, pa.scalar(None, pa.int64()), row_numbers),
+        'qty': parse_quantities(batch.column(3)),
+    }).filter(pc.not_equal(code, ''))
+
+    magnitude = pc.sum(pc.abs(pc.cast(rows['qty'], pa.float64(), safe=False))).as_py() or 0.0
+    return group_by_shop_and_code(rows), magnitude
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def analyze_sales_from_string(csv_content, allowed_branches):
+    """
+    Analyze sales data from CSV string content.
+    Groups by shop and product code, then sums quantities.
+    Only processes shops in the allowed_branches list.
+    Uses case-insensitive matching; shops are reported with the casing
+    given in allowed_branches (first spelling wins).
+    Returns (sales_data, product_totals, shop_totals).
+    Results are cached across reruns, keyed by the content and the branch tuple.
+    """
+    sales_data = {}
+    product_totals = {}
+    shop_totals = {}
+
+    if isinstance(csv_content, str):
+        csv_content = csv_content.encode('utf-8')
+    # Map lowercase branch names to their canonical (first-listed) case
+    canonical = {}
+    for branch in allowed_branches:
+        branch = branch.strip()
+        canonical.setdefault(branch.lower(), branch)
+    # Rows are kept only when their shop matches an allowed branch exactly, so
+    # the summary-row check can run once per branch instead of once per row
+    allowed_lower = frozenset(
+        branch_lower for branch_lower in canonical if not is_summary_shop(branch_lower)
+    )
+
+    # Aggregate batch by batch while the reader parses ahead, then merge the
+    # partial per-batch groups
+    ragged_rows = []
+    try:
+        reader = open_sales_reader(csv_content, allowed_lower, ragged_rows)
+        if reader is None:
+            return sales_data, product_totals, shop_totals
+        partials = aggregate_batches(reader, allowed_lower)
+    except pa.ArrowKeyError:
+        # Header has fewer columns than the report format; as with csv.reader,
+        # only the data rows' widths matter
+        partials = aggregate_batches(parse_sales_batches(csv_content), allowed_lower)
+    except pa.ArrowInvalid:
+        if not ragged_rows:
+            raise
+        # Keep every row wide enough to hold a quantity, as csv.reader did
+        partials = aggregate_batches(parse_sales_batches(csv_content), allowed_lower)
+    if not partials:
+        return sales_data, product_totals, shop_totals
+    per_shop = group_by_shop_and_code(pa.concat_tables(partials))
+
+    # Each (shop, code) group appears once, so entries are assigned, not summed
+    for shop_lower, product_code, product_name, quantity in zip(
+        per_shop['shop_lower'].to_pylist(),
+        per_shop['code'].to_pylist(),
+        per_shop['name'].to_pylist(),
+        per_shop['qty'].to_pylist(),
+    ):
+        sales_data.setdefault(canonical[shop_lower], {})[product_code] = {
+            'name': product_name or '',
+            'quantity': quantity,
+        }
+
+    # Sum shop totals as int64 in Arrow rather than accumulating Python ints
+    per_branch = per_shop.group_by('shop_lower', use_threads=False).aggregate([('qty', 'sum')])
+    for shop_lower, quantity in zip(
+        per_branch['shop_lower'].to_pylist(),
+        per_branch['qty_sum'].to_pylist(),
+    ):
+        shop_totals[canonical[shop_lower]] = quantity
+
+    # Product totals only need the (shop, code) groups, not every row
+    # Visit groups by their first named row so 'first' matches file order
+    per_product = (
+        per_shop.sort_by('name_row')
+        .group_by('code', use_threads=False)
+        .aggregate([('qty', 'sum'), ('name', 'first')])
+    )
+    for product_code, product_name, quantity in zip(
+        per_product['code'].to_pylist(),
+        per_product['name_first'].to_pylist(),
+        per_product['qty_sum'].to_pylist(),
+    ):
+        product_totals[product_code] = {'name': product_name or '', 'quantity': quantity}
+
+    return sales_data, product_totals, shop_totals
+
+
+def generate_csv_string(sales_data, product_totals, shop_totals):
     """
     Generate CSV content as string from sales data.
     Properly formatted with comma delimiter for column separation.
@@ -118,13 +318,13 @@ def generate_csv_string(sales_data, product_totals):
     writer.writerow(['TOTAL SALES BY PRODUCT (ACROSS ALL BRANCHES)'])
     writer.writerow(['Product Code', 'Product Name', 'Total Quantity'])
 
-    for product_code in sorted(product_totals.keys()):
-        product_info = product_totals[product_code]
-        product_name = product_info['name']
-        total_qty = product_info['quantity']
-        writer.writerow([product_code, product_name, total_qty])
+    # writerows consumes each section in one call instead of a Python loop per row
+    writer.writerows(
+        [product_code, product_info['name'], product_info['quantity']]
+        for product_code, product_info in sorted(product_totals.items(), key=itemgetter(0))
+    )
 
-    grand_total = sum(product['quantity'] for product in product_totals.values())
+    grand_total = sum(shop_totals.values())
     writer.writerow(['', 'GRAND TOTAL', grand_total])
 
     # ===== SECTION 2: SALES BY BRANCH =====
@@ -132,16 +332,12 @@ def generate_csv_string(sales_data, product_totals):
     writer.writerow(['SALES BY BRANCH'])
     writer.writerow(['Shop', 'Product Code', 'Product Name', 'Total Quantity'])
 
-    for shop in sorted(sales_data.keys()):
-        shop_total = 0
-        for product_code in sorted(sales_data[shop].keys()):
-            product_info = sales_data[shop][product_code]
-            product_name = product_info['name']
-            total_qty = product_info['quantity']
-            shop_total += total_qty
-            writer.writerow([shop, product_code, product_name, total_qty])
-
-        writer.writerow([shop, '', 'SHOP TOTAL', shop_total])
+    for shop, products in sorted(sales_data.items(), key=itemgetter(0)):
+        writer.writerows(
+            [shop, product_code, product_info['name'], product_info['quantity']]
+            for product_code, product_info in sorted(products.items(), key=itemgetter(0))
+        )
+        writer.writerow([shop, '', 'SHOP TOTAL', shop_totals[shop]])
         writer.writerow([])
 
     return output.getvalue()
@@ -161,13 +357,13 @@ st.markdown("Upload a CSV file to analyze sales by branch and product.")
 st.subheader("🔧 Configuration")
 branches_input = st.text_input(
     "Branches to Process",
-    value="AWAISIA, BAHRIA TOWN, IQBAL TOWN, JOHAR TOWN PHARMACY",
+    value=", ".join(ALLOWED_BRANCHES),
     help="Enter branch names separated by commas (case-insensitive matching)"
 )
 
 # Parse branches from input
 if branches_input:
-    allowed_branches = [branch.strip().lower() for branch in branches_input.split(',') if branch.strip()]
+    allowed_branches = [branch.strip() for branch in branches_input.split(',') if branch.strip()]
 else:
     allowed_branches = []
     st.warning("⚠️ Please enter at least one branch name.")
@@ -190,19 +386,17 @@ if uploaded_file is not None:
             # Show file info
             st.success(f"✅ File uploaded: {uploaded_file.name}")
             st.info(f"📁 File size: {len(file_content):,} bytes")
-            # Display branches with original case from input
-            branches_display = [b.strip() for b in branches_input.split(',') if b.strip()]
-            st.info(f"🏪 Processing branches: {', '.join(branches_display)}")
+            st.info(f"🏪 Processing branches: {', '.join(allowed_branches)}")
 
             # Process file
             with st.spinner("Processing file..."):
-                sales_data, product_totals = analyze_sales_from_string(
-                    file_content, 
-                    allowed_branches
+                sales_data, product_totals, shop_totals = analyze_sales_from_string(
+                    file_content,
+                    tuple(allowed_branches)
                 )
 
             # Generate CSV output
-            csv_output = generate_csv_string(sales_data, product_totals)
+            csv_output = generate_csv_string(sales_data, product_totals, shop_totals)
 
             # Display summary statistics
             st.subheader("📈 Summary Statistics")
@@ -210,7 +404,7 @@ if uploaded_file is not None:
 
             total_shops = len(sales_data)
             total_products = len(product_totals)
-            grand_total = sum(product['quantity'] for product in product_totals.values())
+            grand_total = sum(shop_totals.values())
 
             with col1:
                 st.metric("Total Shops", total_shops)
@@ -225,16 +419,10 @@ if uploaded_file is not None:
             # Show branch summary
             if sales_data:
                 st.markdown("**Sales by Branch:**")
-                branch_summary = []
-                for shop in sorted(sales_data.keys()):
-                    shop_total = sum(
-                        product['quantity'] 
-                        for product in sales_data[shop].values()
-                    )
-                    branch_summary.append({
-                        'Shop': shop,
-                        'Total Quantity': shop_total
-                    })
+                branch_summary = [
+                    {'Shop': shop, 'Total Quantity': shop_totals[shop]}
+                    for shop in sorted(shop_totals.keys())
+                ]
 
                 st.dataframe(branch_summary, use_container_width=True)
 